@@ -3,11 +3,17 @@ Client corrigé pour l'API Airtable - Récupération des factures fournisseurs
 Adaptation pour tenir compte des champs manquants ou différents
 Version améliorée pour gérer l'absence des colonnes ID_Sellsy_Facture_
 """
-from pyairtable import Table
-import requests
 import os
+import re
+import json
+import time
+import shutil
+import hashlib
 import tempfile
+import threading
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import (  # Changé config_fixed en config
     AIRTABLE_API_KEY, 
     AIRTABLE_BASE_ID, 
@@ -21,30 +27,208 @@ from config import (  # Changé config_fixed en config
     AIRTABLE_SUBSCRIBER_ID_COLUMN,
     AIRTABLE_SUBSCRIBER_FIRSTNAME_COLUMN,
     AIRTABLE_SUBSCRIBER_LASTNAME_COLUMN,
+    AIRTABLE_SCHEMA_CACHE_DIR,
+    AIRTABLE_SCHEMA_CACHE_TTL,
+    AIRTABLE_SCHEMA_CACHE_MAX_STALE,
+    AIRTABLE_SYNC_STATE_DIR,
+    AIRTABLE_ATTACHMENT_CACHE_DIR,
+    AIRTABLE_DOWNLOAD_WORKERS,
+    AIRTABLE_DOWNLOAD_TMP_DIR,
+    AIRTABLE_NEEDS_SYNC_VIEW,
+    AIRTABLE_LAST_MODIFIED_COLUMN,
+    AIRTABLE_REQUESTS_PER_SECOND,
     TRUST_COLUMN_MAPPING  # Nouvelle option ajoutée dans config.py
 )
 
-# Configuration du logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Nombre maximum d'enregistrements conservés dans le cache de lecture
+RECORD_CACHE_SIZE = 512
+
+# Taille des blocs copiés lors du téléchargement des pièces jointes (1 Mio)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Délais d'attente des téléchargements (connexion, lecture) en secondes
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Nombre d'envois d'une mise à jour de statut avant de l'abandonner
+MAX_UPDATE_ATTEMPTS = 3
+
+# Nombre de reprises d'un parcours dont le curseur de pagination a expiré
+MAX_LISTING_RESTARTS = 3
+
+# Marge retirée du point de reprise de la synchronisation incrémentale (décalage d'horloge)
+SYNC_WATERMARK_MARGIN = 300
+
+# Longueur maximale d'une formule filterByFormula (limite de longueur d'URL d'Airtable)
+MAX_FORMULA_LENGTH = 16000
+
+# Le logging est configuré par l'application (voir configure_logging)
 logger = logging.getLogger("airtable_api")
+logger.addHandler(logging.NullHandler())
+
+def configure_logging(level=logging.INFO):
+    """
+    Configuration par défaut du logging, à appeler explicitement par les scripts
+    qui utilisent ce module sans configurer eux-mêmes le logging
+    
+    Args:
+        level (int, optional): Niveau de log minimal
+    """
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+class _RateLimiter:
+    """
+    Seau à jetons limitant le nombre de requêtes envoyées à une base Airtable
+    Autorise une rafale de `burst` requêtes puis un rythme de `rate` requêtes par seconde
+    """
+    
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst or rate)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Attend qu'un jeton soit disponible puis le consomme"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            
+            if self._tokens < 1:
+                # Attendre sous le verrou garde l'ordre d'arrivée des appelants
+                time.sleep((1 - self._tokens) / self._rate)
+                self._tokens = 1
+                self._last = time.monotonic()
+            
+            self._tokens -= 1
+
+# OPTIMISATION: Un seul limiteur partagé par toutes les instances, la limite étant par base
+_rate_limiter = _RateLimiter(AIRTABLE_REQUESTS_PER_SECOND)
+
+def _is_airtable_error(error, error_type):
+    """
+    Indique si Airtable a rejeté une requête (422) avec le type d'erreur indiqué
+    
+    Args:
+        error (Exception): Erreur levée par pyairtable
+        error_type (str): Type d'erreur Airtable (ex: UNKNOWN_FIELD_NAME)
+        
+    Returns:
+        bool: True si l'erreur correspond
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) != 422:
+        return False
+    return error_type in f"{error} {getattr(response, 'text', '')}"
 
 class AirtableAPI:
     def __init__(self):
         """Initialise la connexion à l'API Airtable"""
+        # OPTIMISATION: Import différé des dépendances lourdes, seuls les utilisateurs
+        # du client paient leur coût de chargement (pas les scripts qui lisent les constantes)
+        from pyairtable import Table
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self._requests = requests
+        
         self.table = Table(AIRTABLE_API_KEY, AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME)
-        logger.info(f"Connexion à Airtable établie pour la table {AIRTABLE_TABLE_NAME}")
+        logger.info("Connexion à Airtable établie pour la table %s", AIRTABLE_TABLE_NAME)
+        
+        # OPTIMISATION: Session HTTP partagée (keep-alive, pool de connexions, nouvelles tentatives)
+        # pour éviter une nouvelle poignée de main TCP+TLS à chaque téléchargement de pièce jointe
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=max(16, AIRTABLE_DOWNLOAD_WORKERS),
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # Limite le nombre de téléchargements simultanés (AIRTABLE_DOWNLOAD_WORKERS)
+        self._download_slots = threading.Semaphore(AIRTABLE_DOWNLOAD_WORKERS)
+        
+        # OPTIMISATION: Mises à jour en attente, envoyées par lots de 10 via batch_update
+        self._pending_updates = {}
+        # Nombre d'envois déjà échoués par enregistrement, pour les mises à jour remises en attente
+        self._update_attempts = {}
+        # Statuts globaux en attente, envoyés séparément une fois les statuts des factures confirmés
+        self._pending_global_updates = {}
+        # Totaux de l'exécution, y compris les envois faits lors d'une reprise du parcours
+        self.synced_file_count = 0
+        self.failed_file_count = 0
+        # Avancement de la synchronisation par enregistrement, pour calculer le statut global
+        # sans relire l'enregistrement: {record_id: {'total': int, 'done': set, 'pending': deque, 'synced': bool}}
+        self._sync_progress = {}
+        # Enregistrements inconnus de _sync_progress dont le statut global doit être relu
+        self._global_check_pending = set()
+        # Enregistrements relus dont le statut global est déjà à True, inutile de le revérifier
+        self._globally_synced = set()
+        # OPTIMISATION: Derniers enregistrements lus ou renvoyés par une mise à jour, pour éviter
+        # de relire un enregistrement déjà connu (au plus RECORD_CACHE_SIZE entrées)
+        self._record_cache = {}
         
         # CORRECTION: Vérifier quels champs existent réellement dans la table
         self._check_table_structure()
+        
+        # OPTIMISATION: Plan des colonnes, formule de filtrage et projection calculés une seule fois
+        self._column_plan = self._build_column_plan()
+        self._column_plan_by_file = {plan[0]: plan for plan in self._column_plan}
+        # Couples (colonne de facture, colonne de statut) utilisés par le filtre en mémoire
+        self._sync_pairs = tuple((file_col, sync_col) for file_col, sync_col, _ in self._column_plan if sync_col)
+        self._sync_file_columns = frozenset(file_col for file_col, _ in self._sync_pairs)
+        self._sync_columns = frozenset(sync_col for _, sync_col in self._sync_pairs)
+        # Une vue Airtable dédiée, si elle est configurée, remplace la formule de filtrage
+        # (_build_unsync_formulas renseigne aussi les couples couverts par chaque formule)
+        self._unsync_formula_pairs = ()
+        self._unsync_formulas = () if AIRTABLE_NEEDS_SYNC_VIEW else self._build_unsync_formulas()
+        # Le filtre Airtable suffit lorsque l'on fait confiance au mapping
+        # (le contenu d'une vue configurée manuellement est toujours revérifié en mémoire)
+        self._server_filtered = TRUST_COLUMN_MAPPING and bool(self._unsync_formulas)
+        # OPTIMISATION: Synchronisation incrémentale à partir du dernier point de reprise
+        self._run_started_at = time.time()
+        # Le point de reprise n'avance qu'après un parcours complet de la table
+        self._listing_complete = False
+        self.listing_failed = False
+        self._unsync_formulas = self._apply_sync_watermark(self._unsync_formulas)
+        self._read_fields = self._build_read_fields()
+        # Correspondance clé de invoice_data -> colonne Airtable (None si la colonne est absente)
+        self._invoice_field_map = (
+            ("subscriber_id", AIRTABLE_SUBSCRIBER_ID_COLUMN if self.has_subscriber_id else None),
+            ("first_name", AIRTABLE_SUBSCRIBER_FIRSTNAME_COLUMN if self.has_firstname else None),
+            ("last_name", AIRTABLE_SUBSCRIBER_LASTNAME_COLUMN if self.has_lastname else None),
+        )
     
+    def close(self):
+        """
+        Envoie les mises à jour encore en attente puis libère les connexions HTTP
+        conservées par la session de téléchargement
+        """
+        try:
+            _, failed_count = self.flush_updates()
+            if failed_count:
+                logger.error("%s factures n'ont pas pu être marquées comme synchronisées", failed_count)
+        finally:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def _check_table_structure(self):
         """
         Vérifie la structure de la table Airtable pour déterminer quels champs existent réellement
         Version corrigée qui fait confiance au mapping si l'option est activée
         """
+        # Noms des colonnes de la table, s'ils ont pu être lus (None sinon)
+        self._table_fields = None
+        
         # CORRECTION: Faire confiance au mapping défini si l'option est activée
         if TRUST_COLUMN_MAPPING:
             logger.info("Utilisation du mapping de colonnes défini dans config.py sans vérification")
@@ -57,9 +241,9 @@ class AirtableAPI:
             return
         
         try:
-            # Récupérer plusieurs enregistrements pour une meilleure détection
-            records = self.table.all(max_records=10)  # Examiner jusqu'à 10 enregistrements
-            if not records:
+            # OPTIMISATION: Schéma lu via l'API Meta (avec cache disque) plutôt que par un échantillon d'enregistrements
+            all_fields = self._get_table_field_names()
+            if not all_fields:
                 logger.warning("Table vide ou inaccessible, impossible de vérifier sa structure")
                 # Initialiser avec des valeurs par défaut en cas d'échec
                 self.has_subscriber_id = False
@@ -70,13 +254,9 @@ class AirtableAPI:
                 self.sellsy_id_columns = {}
                 return
             
-            # Combiner tous les champs trouvés dans tous les enregistrements
-            all_fields = set()
-            for record in records:
-                fields = record.get('fields', {})
-                all_fields.update(fields.keys())
-                
-            logger.info(f"Champs détectés dans Airtable: {', '.join(all_fields)}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Champs détectés dans Airtable: %s", ', '.join(all_fields))
+            self._table_fields = frozenset(all_fields)
             
             # Vérifier les champs globaux
             self.has_subscriber_id = AIRTABLE_SUBSCRIBER_ID_COLUMN in all_fields
@@ -90,7 +270,7 @@ class AirtableAPI:
                 if file_col in all_fields and status_col in all_fields:
                     self.sync_status_columns[file_col] = status_col
                 elif file_col in all_fields:
-                    logger.warning(f"Colonne de fichier {file_col} existe mais pas sa colonne de statut {status_col}")
+                    logger.warning("Colonne de fichier %s existe mais pas sa colonne de statut %s", file_col, status_col)
                     # Continuer sans le statut, on considérera toujours non synchronisé
                     
             # Vérifier les champs d'ID Sellsy
@@ -100,16 +280,16 @@ class AirtableAPI:
                     self.sellsy_id_columns[file_col] = id_col
                     
             # Journaliser les résultats
-            logger.info(f"Structure de table détectée:")
-            logger.info(f"  - Champ ID Abonné: {self.has_subscriber_id}")
-            logger.info(f"  - Champ Prénom: {self.has_firstname}")
-            logger.info(f"  - Champ Nom: {self.has_lastname}")
-            logger.info(f"  - Statut global de synchronisation: {self.has_global_sync}")
-            logger.info(f"  - Colonnes de statut de synchronisation: {len(self.sync_status_columns)}")
-            logger.info(f"  - Colonnes d'ID Sellsy: {len(self.sellsy_id_columns)}")
+            logger.info("Structure de table détectée:")
+            logger.info("  - Champ ID Abonné: %s", self.has_subscriber_id)
+            logger.info("  - Champ Prénom: %s", self.has_firstname)
+            logger.info("  - Champ Nom: %s", self.has_lastname)
+            logger.info("  - Statut global de synchronisation: %s", self.has_global_sync)
+            logger.info("  - Colonnes de statut de synchronisation: %s", len(self.sync_status_columns))
+            logger.info("  - Colonnes d'ID Sellsy: %s", len(self.sellsy_id_columns))
             
         except Exception as e:
-            logger.error(f"Erreur lors de la vérification de la structure de la table: {e}")
+            logger.error("Erreur lors de la vérification de la structure de la table: %s", e)
             # Initialiser avec des valeurs par défaut en cas d'échec
             self.has_subscriber_id = False
             self.has_firstname = False
@@ -118,120 +298,509 @@ class AirtableAPI:
             self.sync_status_columns = {}
             self.sellsy_id_columns = {}
 
-    def get_unsynchronized_invoices(self, limit=None):
+    def _get_table_field_names(self):
+        """
+        Détermine les noms des colonnes de la table, en privilégiant le cache disque
+        puis l'API Meta d'Airtable, et en dernier recours un échantillon d'enregistrements
+        
+        Returns:
+            set: Noms des colonnes de la table
         """
-        Récupère les factures fournisseurs non encore synchronisées avec Sellsy
+        field_names = self._load_cached_schema()
+        if field_names is not None:
+            logger.info("Structure de table chargée depuis le cache")
+            return field_names
+        
+        # OPTIMISATION: Un cache expiré mais récent est utilisé tout de suite,
+        # et rafraîchi en arrière-plan pour la prochaine exécution
+        field_names = self._load_cached_schema(max_age=AIRTABLE_SCHEMA_CACHE_MAX_STALE)
+        if field_names is not None:
+            logger.info("Structure de table chargée depuis un cache expiré, rafraîchissement en arrière-plan")
+            threading.Thread(target=self._refresh_cached_schema, daemon=True).start()
+            return field_names
+        
+        field_names = self._fetch_schema_via_meta()
+        if field_names is not None:
+            self._save_cached_schema(field_names)
+            return field_names
+        
+        # Récupérer plusieurs enregistrements pour une meilleure détection
+        _rate_limiter.acquire()
+        records = self.table.all(max_records=10)  # Examiner jusqu'à 10 enregistrements
+        
+        # Combiner tous les champs trouvés dans tous les enregistrements
+        field_names = set()
+        for record in records:
+            field_names.update(record.get('fields', {}).keys())
+        return field_names
+
+    def _fetch_schema_via_meta(self):
+        """
+        Récupère la liste des colonnes de la table via l'API Meta d'Airtable
+        
+        Returns:
+            set: Noms des colonnes, ou None si l'API Meta refuse la requête ou ne connaît pas la table
+        """
+        url = f"https://api.airtable.com/v0/meta/bases/{AIRTABLE_BASE_ID}/tables"
+        headers = {"Authorization": f"Bearer {AIRTABLE_API_KEY}"}
+        
+        # L'API Meta compte dans la même limite de débit que les autres appels à la base
+        _rate_limiter.acquire()
+        response = self._requests.get(url, headers=headers, timeout=30)
+        if 400 <= response.status_code < 500:
+            logger.warning("API Meta indisponible (%s), détection par échantillon d'enregistrements", response.status_code)
+            return None
+        response.raise_for_status()
+        
+        for table in response.json().get("tables", []):
+            if AIRTABLE_TABLE_NAME in (table.get("name"), table.get("id")):
+                return {field["name"] for field in table.get("fields", [])}
+        
+        logger.warning("Table %s absente du schéma renvoyé par l'API Meta", AIRTABLE_TABLE_NAME)
+        return None
+
+    def _refresh_cached_schema(self):
+        """Relit le schéma via l'API Meta et met à jour le cache disque (exécuté en arrière-plan)"""
+        try:
+            field_names = self._fetch_schema_via_meta()
+            if field_names is not None:
+                self._save_cached_schema(field_names)
+        except Exception as e:
+            logger.warning("Échec du rafraîchissement du cache du schéma: %s", e)
+
+    def _schema_cache_path(self):
+        """Chemin du fichier de cache du schéma pour la base et la table configurées"""
+        cache_key = re.sub(r"[^A-Za-z0-9_-]", "_", f"{AIRTABLE_BASE_ID}_{AIRTABLE_TABLE_NAME}")
+        return os.path.join(AIRTABLE_SCHEMA_CACHE_DIR, f"airtable_schema_{cache_key}.json")
+
+    def _load_cached_schema(self, max_age=AIRTABLE_SCHEMA_CACHE_TTL):
+        """
+        Charge la liste des colonnes depuis le cache disque si elle est encore valide
         
         Args:
-            limit (int, optional): Nombre maximum de factures à récupérer
+            max_age (int, optional): Âge maximal accepté pour le cache, en secondes
             
         Returns:
-            list: Liste des enregistrements Airtable
+            set: Noms des colonnes, ou None si le cache est absent, expiré ou illisible
         """
+        cache_path = self._schema_cache_path()
         try:
-            logger.info("Récupération des enregistrements Airtable...")
+            if time.time() - os.path.getmtime(cache_path) > max_age:
+                return None
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return set(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def _save_cached_schema(self, field_names):
+        """
+        Enregistre la liste des colonnes dans le cache disque (écriture atomique)
+        
+        Args:
+            field_names (set): Noms des colonnes de la table
+        """
+        cache_path = self._schema_cache_path()
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(sorted(field_names), f, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Impossible d'écrire le cache du schéma %s: %s", cache_path, e)
+
+    def _build_column_plan(self):
+        """
+        Résout une seule fois, pour chaque colonne de facture, les colonnes de statut
+        et d'ID Sellsy effectivement utilisables (en tenant compte de TRUST_COLUMN_MAPPING)
+        
+        Returns:
+            tuple: Triplets (colonne de facture, colonne de statut ou None, colonne d'ID Sellsy ou None)
+        """
+        column_plan = []
+        for file_col in AIRTABLE_INVOICE_FILE_COLUMNS:
+            sync_col = self.sync_status_columns.get(file_col)
+            sellsy_id_col = self.sellsy_id_columns.get(file_col)
             
-            # Récupérer tous les enregistrements sans filtrage initial
-            # Nous filtrerons en mémoire pour plus de fiabilité
-            if limit:
-                records = self.table.all(max_records=limit)
-            else:
-                records = self.table.all()
+            # CORRECTION: Avec TRUST_COLUMN_MAPPING activé, on fait confiance au mapping défini
+            if TRUST_COLUMN_MAPPING:
+                sync_col = sync_col or AIRTABLE_SYNC_STATUS_COLUMNS.get(file_col)
+                sellsy_id_col = sellsy_id_col or AIRTABLE_SELLSY_ID_COLUMNS.get(file_col)
             
-            logger.info(f"Récupération de {len(records)} enregistrements au total")
+            column_plan.append((file_col, sync_col or None, sellsy_id_col or None))
+        
+        return tuple(column_plan)
+
+    def _build_unsync_formulas(self):
+        """
+        Construit la formule Airtable qui sélectionne les enregistrements ayant au moins
+        une facture attachée dont le statut de synchronisation n'est pas coché
+        Si elle dépasse MAX_FORMULA_LENGTH, elle est découpée en plusieurs formules
+        portant chacune sur un groupe de colonnes
+        
+        Returns:
+            tuple: Formules filterByFormula, vide si aucune colonne de statut n'est connue
+        """
+        conditions = []
+        for file_col, sync_col in self._sync_pairs:
+            # LEN(ARRAYJOIN(...)) est l'idiome Airtable pour tester une liste de pièces jointes non vide
+            conditions.append(((file_col, sync_col), f"AND(LEN(ARRAYJOIN({{{file_col}}}))>0,NOT({{{sync_col}}}))"))
+        
+        if not conditions:
+            logger.warning("Aucune colonne de statut connue, filtrage côté Airtable désactivé")
+            return ()
+        
+        # Regrouper les conditions tant que la formule reste sous la limite de longueur
+        groups = [[]]
+        group_length = len("OR()")
+        for pair, condition in conditions:
+            if groups[-1] and group_length + len(condition) + 1 > MAX_FORMULA_LENGTH:
+                groups.append([])
+                group_length = len("OR()")
+            groups[-1].append((pair, condition))
+            group_length += len(condition) + 1
+        
+        if len(groups) > 1:
+            logger.info("Formule de filtrage découpée en %s requêtes", len(groups))
+        
+        self._unsync_formula_pairs = tuple(tuple(pair for pair, _ in group) for group in groups)
+        return tuple("OR(" + ",".join(condition for _, condition in group) + ")" for group in groups)
+
+    def _sync_state_path(self):
+        """Chemin du fichier contenant le point de reprise de la synchronisation incrémentale"""
+        state_key = re.sub(r"[^A-Za-z0-9_-]", "_", f"{AIRTABLE_BASE_ID}_{AIRTABLE_TABLE_NAME}")
+        return os.path.join(AIRTABLE_SYNC_STATE_DIR, f"airtable_sync_state_{state_key}.json")
+
+    def _apply_sync_watermark(self, formulas):
+        """
+        Restreint les formules de filtrage aux enregistrements modifiés depuis la dernière
+        synchronisation sans erreur (si AIRTABLE_LAST_MODIFIED_COLUMN est configurée)
+        
+        Args:
+            formulas (tuple): Formules filterByFormula
             
-            # Filtrer en mémoire pour trouver les enregistrements avec des factures non synchronisées
-            validated_records = []
-            for record in records:
-                fields = record.get('fields', {})
-                has_unsync_file = False
-                
-                for column in AIRTABLE_INVOICE_FILE_COLUMNS:
-                    # Vérifier si la colonne de fichier existe dans l'enregistrement
-                    attachments = fields.get(column, [])
-                    if attachments:
-                        # Utiliser la colonne de statut correspondante si elle existe
-                        sync_column = self.sync_status_columns.get(column)
-                        if sync_column:
-                            # CORRECTION: Considérer explicitement que False ou champ manquant = non synchronisé
-                            is_synced = fields.get(sync_column, False)
-                            if not is_synced:
-                                has_unsync_file = True
-                                break
-                        else:
-                            # CORRECTION: Avec TRUST_COLUMN_MAPPING, on considère que la colonne existe
-                            if TRUST_COLUMN_MAPPING and column in AIRTABLE_SYNC_STATUS_COLUMNS:
-                                logger.info(f"Colonne {column} considérée comme non synchronisée (confiance au mapping)")
-                                has_unsync_file = True
-                                break
-                            else:
-                                logger.warning(f"Colonne de statut manquante pour {column} dans l'enregistrement {record.get('id', 'inconnu')}, ignorée")
-                                continue
-                
-                if has_unsync_file:
-                    validated_records.append(record)
+        Returns:
+            tuple: Formules complétées, ou inchangées en l'absence de point de reprise
+        """
+        if not AIRTABLE_LAST_MODIFIED_COLUMN:
+            return formulas
+        
+        try:
+            with open(self._sync_state_path(), 'r', encoding='utf-8') as f:
+                last_sync_at = float(json.load(f)["last_sync_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.info("Aucun point de reprise de synchronisation, parcours complet de la table")
+            return formulas
+        
+        since = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(last_sync_at))
+        logger.info("Synchronisation incrémentale des enregistrements modifiés depuis %s", since)
+        condition = f"IS_AFTER({{{AIRTABLE_LAST_MODIFIED_COLUMN}}},DATETIME_PARSE('{since}'))"
+        return tuple(f"AND({condition},{formula})" for formula in formulas) or (condition,)
+
+    def save_sync_watermark(self):
+        """
+        Enregistre le début de l'exécution courante comme point de reprise de la prochaine
+        synchronisation incrémentale (à n'appeler qu'après une exécution sans erreur)
+        """
+        if not AIRTABLE_LAST_MODIFIED_COLUMN:
+            return
+        
+        # CORRECTION: Un parcours interrompu (erreur de pagination, limite, arrêt anticipé)
+        # laisserait de côté les enregistrements des pages non lues
+        if not self._listing_complete:
+            logger.warning("Parcours de la table incomplet, point de reprise inchangé")
+            return
+        
+        state_path = self._sync_state_path()
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            tmp_path = f"{state_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"last_sync_at": self._run_started_at - SYNC_WATERMARK_MARGIN}, f)
+            os.replace(tmp_path, state_path)
+        except OSError as e:
+            logger.warning("Impossible d'enregistrer le point de reprise %s: %s", state_path, e)
+
+    def _build_read_fields(self):
+        """
+        Détermine les colonnes à demander à Airtable (factures, statuts, statut global
+        et informations abonné) afin de ne pas télécharger les autres colonnes
+        Les colonnes d'ID Sellsy, seulement écrites, ne sont pas relues
+        
+        Returns:
+            tuple: Noms des colonnes à récupérer, vide si aucune projection n'est possible
+        """
+        fields = []
+        for file_col, sync_col, _ in self._column_plan:
+            # CORRECTION: Lire aussi les colonnes de facture sans colonne de statut, qui doivent
+            # compter dans le total de _track_sync_progress et bloquer le statut global
+            if self._table_fields is not None and file_col not in self._table_fields:
+                continue
+            fields.append(file_col)
+            if sync_col:
+                fields.append(sync_col)
+        
+        if not fields:
+            return ()
+        
+        if self.has_global_sync:
+            fields.append(AIRTABLE_SYNCED_COLUMN)
+        if self.has_subscriber_id:
+            fields.append(AIRTABLE_SUBSCRIBER_ID_COLUMN)
+        if self.has_firstname:
+            fields.append(AIRTABLE_SUBSCRIBER_FIRSTNAME_COLUMN)
+        if self.has_lastname:
+            fields.append(AIRTABLE_SUBSCRIBER_LASTNAME_COLUMN)
+        
+        return tuple(dict.fromkeys(fields))
+
+    def _list_options(self, limit=None, formula=None):
+        """
+        Prépare les paramètres de listage Airtable (vue, formule, projection, pagination)
+        
+        Args:
+            limit (int, optional): Nombre maximum d'enregistrements à récupérer
+            formula (str, optional): Formule filterByFormula à appliquer
             
-            logger.info(f"Après validation: {len(validated_records)} enregistrements avec factures non synchronisées")
-            return validated_records
+        Returns:
+            dict: Paramètres à passer à Table.all ou Table.iterate
+        """
+        options = {"page_size": 100}
+        if AIRTABLE_NEEDS_SYNC_VIEW:
+            options["view"] = AIRTABLE_NEEDS_SYNC_VIEW
+        if formula:
+            options["formula"] = formula
+        if self._read_fields:
+            options["fields"] = list(self._read_fields)
+        if limit:
+            # Ne pas demander une page plus grande que le nombre d'enregistrements attendus
+            options["page_size"] = min(100, limit)
+            options["max_records"] = limit
+        return options
+
+    def _iterate_pages(self, **options):
+        """
+        Parcourt les pages de Table.iterate en respectant la limite de débit d'Airtable
+        (chaque page correspond à une requête HTTP)
+        
+        Args:
+            **options: Paramètres à passer à Table.iterate
             
-        except Exception as e:
-            logger.error(f"Erreur lors de la récupération des factures: {e}")
-            return []
+        Yields:
+            list: Page d'enregistrements Airtable
+        """
+        pages = None
+        first_page = True
+        restarts = 0
+        while True:
+            _rate_limiter.acquire()
+            try:
+                if pages is None:
+                    pages = iter(self.table.iterate(**options))
+                page = next(pages, None)
+            except Exception as e:
+                # CORRECTION: Le curseur de pagination expire si la page suivante tarde à être demandée
+                # (traitement des factures de la page courante); reprendre le parcours au début après
+                # avoir envoyé les statuts en attente, pour que la formule écarte les factures traitées
+                if _is_airtable_error(e, "LIST_RECORDS_ITERATOR_NOT_AVAILABLE") and restarts < MAX_LISTING_RESTARTS:
+                    restarts += 1
+                    logger.warning("Curseur de pagination Airtable expiré, reprise du parcours (%s/%s)",
+                                   restarts, MAX_LISTING_RESTARTS)
+                    self.flush_updates()
+                    pages = None
+                    continue
+                
+                # CORRECTION: Avec TRUST_COLUMN_MAPPING, les colonnes facultatives ne sont pas vérifiées;
+                # une seule colonne absente fait rejeter toute la projection, relire alors sans projection
+                if not (first_page and "fields" in options and _is_airtable_error(e, "UNKNOWN_FIELD_NAME")):
+                    raise
+                logger.warning("Colonne introuvable dans la projection, lecture de toutes les colonnes: %s", e)
+                self._read_fields = ()
+                del options["fields"]
+                pages = None
+                continue
+            
+            if page is None:
+                return
+            first_page = False
+            yield page
 
-    def get_next_unsynchronized_file(self, record):
+    def _is_unsynchronized(self, record):
         """
-        Trouve la prochaine colonne de facture non synchronisée dans un enregistrement
-        Version améliorée avec vérification stricte des colonnes
+        Vérifie en mémoire qu'un enregistrement contient au moins une facture non synchronisée
         
         Args:
             record (dict): Enregistrement Airtable
             
         Returns:
-            str: Nom de la colonne contenant une facture non synchronisée, ou None si tout est synchronisé
+            bool: True si une facture reste à synchroniser
         """
         fields = record.get('fields', {})
-        record_id = record.get('id', 'inconnu')
         
-        logger.info(f"Recherche de factures non synchronisées pour l'enregistrement {record_id}")
+        # OPTIMISATION: Airtable omet les champs vides, un test d'intersection (en C)
+        # écarte directement les enregistrements sans aucune facture suivie
+        if self._sync_file_columns.isdisjoint(fields):
+            return False
         
-        # Vérifier chaque colonne de facture dans l'ordre défini
-        for column in AIRTABLE_INVOICE_FILE_COLUMNS:
-            # Vérifier si la colonne existe et contient un fichier
-            attachments = fields.get(column, [])
-            if not attachments:
-                logger.debug(f"Colonne {column} : pas de fichier attaché")
-                continue
+        return self._has_unsynchronized_pair(record, self._sync_pairs)
+
+    def _has_unsynchronized_pair(self, record, pairs):
+        """
+        Vérifie en mémoire qu'un des couples (colonne de facture, colonne de statut)
+        indiqués a une facture attachée dont le statut n'est pas coché
+        
+        Args:
+            record (dict): Enregistrement Airtable
+            pairs (tuple): Couples (colonne de facture, colonne de statut)
             
-            # Récupérer le nom exact de la colonne de statut correspondante
-            sync_column = self.sync_status_columns.get(column)
+        Returns:
+            bool: True si une de ces factures reste à synchroniser
+        """
+        get = record.get('fields', {}).get
+        # CORRECTION: Considérer explicitement que False ou champ manquant = non synchronisé
+        # Les colonnes sans colonne de statut sont ignorées (voir _track_sync_progress)
+        return any(get(column) and not get(sync_column) for column, sync_column in pairs)
+
+    def _track_sync_progress(self, record):
+        """
+        Mémorise, à partir des champs déjà reçus, le nombre de factures attachées,
+        celles déjà synchronisées et la file ordonnée de celles qui restent à traiter
+        
+        Args:
+            record (dict): Enregistrement Airtable
             
-            # CORRECTION: Avec TRUST_COLUMN_MAPPING activé, on fait confiance au mapping défini
-            if not sync_column and TRUST_COLUMN_MAPPING:
-                sync_column = AIRTABLE_SYNC_STATUS_COLUMNS.get(column)
-                if sync_column:
-                    logger.debug(f"Utilisation du mapping défini pour la colonne de statut: {sync_column}")
+        Returns:
+            dict: Avancement de la synchronisation de l'enregistrement
+        """
+        fields = record.get('fields', {})
+        total = 0
+        done = set()
+        pending = deque()
+        
+        for column, sync_column, _ in self._column_plan:
+            if not fields.get(column):
+                continue
             
+            total += 1
             if not sync_column:
-                # CORRECTION: Ne pas retourner les colonnes sans colonne de statut correspondante
+                # CORRECTION: Ne pas proposer les colonnes sans colonne de statut correspondante
                 # car mark_file_as_synchronized ne pourra pas les traiter
-                logger.warning(f"Colonne de statut manquante pour {column}, ignorée car non modifiable")
-                continue
+                logger.debug("Colonne de statut manquante pour %s, ignorée car non modifiable", column)
+            elif fields.get(sync_column, False):
+                done.add(column)
+            else:
+                pending.append(column)
+        
+        # Valeur actuelle du statut global, pour ne l'écrire que si elle change
+        synced = bool(fields.get(AIRTABLE_SYNCED_COLUMN, False))
+        progress = {'total': total, 'done': done, 'pending': pending, 'synced': synced}
+        self._sync_progress[record.get('id')] = progress
+        return progress
+
+    def get_unsynchronized_invoices(self, limit=None):
+        """
+        Récupère sous forme de liste les factures fournisseurs non encore synchronisées
+        (conservé pour compatibilité, préférer iter_unsynchronized_invoices)
+        
+        Args:
+            limit (int, optional): Nombre maximum de factures à récupérer
+            
+        Returns:
+            list: Enregistrements Airtable contenant au moins une facture non synchronisée
+        """
+        return list(self.iter_unsynchronized_invoices(limit))
+
+    def iter_unsynchronized_invoices(self, limit=None):
+        """
+        Parcourt les factures fournisseurs non encore synchronisées avec Sellsy
+        Les enregistrements sont produits au fil des pages Airtable, sans attendre
+        la fin de la pagination
+        
+        Args:
+            limit (int, optional): Nombre maximum de factures à récupérer
+            
+        Yields:
+            dict: Enregistrements Airtable contenant au moins une facture non synchronisée
+        """
+        server_filtered = self._server_filtered
+        fetched_count = 0
+        yielded_count = 0
+        self._listing_complete = False
+        
+        try:
+            logger.info("Récupération des enregistrements Airtable...")
             
-            # Vérifier explicitement si le statut est False ou manquant/vide
-            is_synced = fields.get(sync_column, False)
+            # OPTIMISATION: Filtrage et projection côté Airtable, lecture page par page
+            for index, formula in enumerate(self._unsync_formulas or (None,)):
+                # OPTIMISATION: Plusieurs formules peuvent renvoyer le même enregistrement; plutôt que
+                # de mémoriser tous les IDs déjà produits, écarter ceux que les formules précédentes
+                # sélectionnent encore (leurs statuts n'ont pas changé depuis)
+                previous_pairs = tuple(pair for pairs in self._unsync_formula_pairs[:index] for pair in pairs)
+                
+                # La limite n'est transmise à Airtable que si aucun filtre en mémoire ne peut
+                # écarter d'enregistrements; sinon l'arrêt anticipé ci-dessous s'en charge
+                remaining = limit - yielded_count if limit and server_filtered else None
+                
+                for page in self._iterate_pages(**self._list_options(remaining, formula)):
+                    fetched_count += len(page)
+                    
+                    for record in page:
+                        if not server_filtered and not self._is_unsynchronized(record):
+                            continue
+                        
+                        if previous_pairs and self._has_unsynchronized_pair(record, previous_pairs):
+                            continue
+                        
+                        self._track_sync_progress(record)
+                        yield record
+                        yielded_count += 1
+                        
+                        if limit and yielded_count >= limit:
+                            return
             
-            # Logging détaillé pour le débogage
-            logger.debug(f"Colonne {column}, statut {sync_column} = {is_synced}")
+            self._listing_complete = True
+        except Exception as e:
+            logger.error("Erreur lors de la récupération des factures: %s", e)
+            self.listing_failed = True
+        finally:
+            logger.info("%s enregistrements récupérés, %s avec factures non synchronisées", fetched_count, yielded_count)
+
+    def get_next_unsynchronized_file(self, record):
+        """
+        Retire et renvoie la prochaine colonne de facture non synchronisée d'un enregistrement
+        La file des colonnes à traiter est calculée une seule fois par enregistrement
+        
+        Args:
+            record (dict): Enregistrement Airtable
             
-            if not is_synced:
-                logger.info(f"Fichier non synchronisé trouvé dans {column} (statut: {is_synced})")
-                return column
-            else:
-                logger.debug(f"Colonne {column} : déjà synchronisée")
+        Returns:
+            str: Nom de la colonne contenant une facture non synchronisée, ou None si tout est synchronisé
+        """
+        record_id = record.get('id', 'inconnu')
+        
+        progress = self._sync_progress.get(record_id)
+        if progress is None:
+            progress = self._track_sync_progress(record)
+        
+        if progress['pending']:
+            column = progress['pending'].popleft()
+            logger.debug("Fichier non synchronisé trouvé dans %s pour l'enregistrement %s", column, record_id)
+            return column
         
-        logger.info(f"Aucune facture non synchronisée trouvée pour l'enregistrement {record_id}")
+        logger.debug("Aucune facture non synchronisée trouvée pour l'enregistrement %s", record_id)
         return None
 
+    def release_record(self, record_id):
+        """
+        Oublie l'avancement d'un enregistrement une fois toutes ses factures traitées
+        (son statut global est déjà en attente d'envoi), pour que la mémoire utilisée
+        ne grandisse pas avec le nombre d'enregistrements parcourus
+        
+        Args:
+            record_id (str): ID de l'enregistrement Airtable
+        """
+        self._sync_progress.pop(record_id, None)
+
     def download_invoice_file(self, record, file_column):
         """
         Télécharge le premier fichier de facture attaché dans une colonne spécifique
@@ -248,7 +817,7 @@ class AirtableAPI:
             attachments = fields.get(file_column, [])
             
             if not attachments:
-                logger.warning(f"Aucune pièce jointe trouvée dans la colonne {file_column} pour l'enregistrement {record.get('id')}")
+                logger.warning("Aucune pièce jointe trouvée dans la colonne %s pour l'enregistrement %s", file_column, record.get('id'))
                 return None, None
                 
             # Récupérer la première pièce jointe
@@ -257,70 +826,165 @@ class AirtableAPI:
             file_name = attachment.get('filename')
             
             if not file_url:
-                logger.warning(f"URL de pièce jointe manquante dans {file_column}")
+                logger.warning("URL de pièce jointe manquante dans %s", file_column)
                 return None, None
                 
-            # Créer un fichier temporaire avec l'extension du fichier original
-            _, file_extension = os.path.splitext(file_name)
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_extension)
-            temp_file_path = temp_file.name
-            temp_file.close()
-            
-            # Télécharger le fichier
-            response = requests.get(file_url, stream=True)
-            response.raise_for_status()
+            _, file_extension = os.path.splitext(file_name or "")
             
-            with open(temp_file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # OPTIMISATION: Réutiliser la copie locale si la pièce jointe a déjà été téléchargée
+            cache_path = self._attachment_cache_path(attachment, file_url, file_extension)
+            if cache_path:
+                if self._is_attachment_cached(cache_path, attachment):
+                    logger.debug("Pièce jointe %s trouvée dans le cache local", file_name)
+                else:
+                    part_path = self._download_attachment(file_url, suffix=".part", directory=AIRTABLE_ATTACHMENT_CACHE_DIR)
+                    os.replace(part_path, cache_path)
+                
+                # L'appelant supprime le fichier après usage: lui remettre une copie du cache
+                fd, temp_file_path = tempfile.mkstemp(suffix=file_extension, dir=AIRTABLE_DOWNLOAD_TMP_DIR or None)
+                os.close(fd)
+                shutil.copyfile(cache_path, temp_file_path)
+            else:
+                temp_file_path = self._download_attachment(
+                    file_url, suffix=file_extension, directory=AIRTABLE_DOWNLOAD_TMP_DIR or None
+                )
                     
-            logger.info(f"Fichier téléchargé avec succès depuis {file_column}: {file_name} -> {temp_file_path}")
+            logger.debug("Fichier téléchargé avec succès depuis %s: %s -> %s", file_column, file_name, temp_file_path)
             return temp_file_path, file_name
             
         except Exception as e:
-            logger.error(f"Erreur lors du téléchargement du fichier depuis {file_column}: {e}")
+            logger.error("Erreur lors du téléchargement du fichier depuis %s: %s", file_column, e)
             return None, None
 
-    def mark_file_as_synchronized(self, record_id, file_column, sellsy_id=None):
+    def _download_attachment(self, file_url, suffix="", directory=None):
+        """
+        Télécharge une pièce jointe dans un nouveau fichier temporaire
+        
+        Args:
+            file_url (str): URL de la pièce jointe
+            suffix (str, optional): Suffixe du fichier temporaire (extension)
+            directory (str, optional): Répertoire du fichier temporaire
+            
+        Returns:
+            str: Chemin du fichier téléchargé
+        """
+        # Télécharger le fichier en réutilisant les connexions de la session
+        with self._download_slots, self._session.get(file_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            
+            # Créer le fichier temporaire une fois la réponse validée,
+            # écrit directement via le descripteur obtenu à la création
+            fd, temp_file_path = tempfile.mkstemp(suffix=suffix, dir=directory)
+            try:
+                # OPTIMISATION: Réserver d'un coup la taille annoncée (allocation contiguë)
+                # lorsque le contenu n'est pas compressé, la taille écrite étant alors connue
+                size = int(response.headers.get('Content-Length') or 0)
+                if size > 0 and not response.headers.get('Content-Encoding') and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(fd, 0, size)
+                    except OSError:
+                        pass  # Système de fichiers sans support de la préallocation
+                
+                with os.fdopen(fd, 'wb', buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                    shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                    # Ne pas garder d'octets préalloués si le contenu reçu est plus court
+                    f.truncate()
+            except Exception:
+                os.unlink(temp_file_path)
+                raise
+        
+        return temp_file_path
+
+    def _attachment_cache_path(self, attachment, file_url, file_extension):
+        """
+        Chemin de la pièce jointe dans le cache local, indexé par l'ID Airtable de la pièce
+        jointe (stable, contrairement aux URLs signées qui expirent) ou à défaut par l'URL
+        
+        Returns:
+            str: Chemin dans le cache, ou None si le cache est désactivé
+        """
+        if not AIRTABLE_ATTACHMENT_CACHE_DIR:
+            return None
+        
+        cache_key = attachment.get('id') or hashlib.sha256(file_url.encode('utf-8')).hexdigest()
+        cache_key = re.sub(r"[^A-Za-z0-9_-]", "_", cache_key)
+        os.makedirs(AIRTABLE_ATTACHMENT_CACHE_DIR, exist_ok=True)
+        return os.path.join(AIRTABLE_ATTACHMENT_CACHE_DIR, f"{cache_key}{file_extension}")
+
+    def _is_attachment_cached(self, cache_path, attachment):
+        """Vérifie que la pièce jointe est présente dans le cache avec la taille annoncée par Airtable"""
+        try:
+            cached_size = os.path.getsize(cache_path)
+        except OSError:
+            return False
+        
+        expected_size = attachment.get('size')
+        return expected_size is None or cached_size == expected_size
+
+    def download_many(self, tasks, max_workers=AIRTABLE_DOWNLOAD_WORKERS):
+        """
+        Télécharge en parallèle les pièces jointes de plusieurs factures
+        
+        Args:
+            tasks (iterable): Couples (enregistrement Airtable, colonne de facture)
+            max_workers (int, optional): Nombre maximum de téléchargements en parallèle
+            
+        Yields:
+            tuple: (enregistrement, colonne, chemin du fichier téléchargé, nom original du fichier)
+                   au fur et à mesure des téléchargements terminés, avec (None, None) en cas d'échec
+        """
+        tasks = list(tasks)
+        if not tasks:
+            return
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as executor:
+            futures = {
+                executor.submit(self.download_invoice_file, record, file_column): (record, file_column)
+                for record, file_column in tasks
+            }
+            for future in as_completed(futures):
+                record, file_column = futures[future]
+                file_path, file_name = future.result()
+                yield record, file_column, file_path, file_name
+
+    def mark_file_as_synchronized(self, record_id, file_column, sellsy_id=None, flush=False, current_fields=None):
         """
         Marque une colonne de facture spécifique comme synchronisée avec Sellsy
-        Version améliorée avec vérifications supplémentaires
+        La mise à jour est mise en attente et envoyée à Airtable par flush_updates
         
         Args:
             record_id (str): ID de l'enregistrement Airtable
             file_column (str): Nom exact de la colonne contenant le fichier synchronisé
             sellsy_id (str, optional): ID Sellsy de la facture créée
+            flush (bool, optional): Envoyer immédiatement la mise à jour de cet enregistrement
+            current_fields (dict, optional): Champs connus de l'enregistrement, pour ignorer
+                                             une colonne déjà marquée comme synchronisée
             
         Returns:
-            bool: True si la mise à jour a réussi, False sinon
+            bool: True si la mise à jour a été mise en attente (ou envoyée si flush), False sinon
         """
         try:
             # Vérifier que le fichier_column est bien dans notre mapping
-            if file_column not in AIRTABLE_INVOICE_FILE_COLUMNS:
-                logger.error(f"Colonne {file_column} non reconnue dans le mapping des colonnes de factures")
+            column_plan = self._column_plan_by_file.get(file_column)
+            if not column_plan:
+                logger.error("Colonne %s non reconnue dans le mapping des colonnes de factures", file_column)
                 return False
             
-            # Identifier la colonne de statut correspondante
-            sync_column = self.sync_status_columns.get(file_column)
-            
-            # CORRECTION: Avec TRUST_COLUMN_MAPPING activé, on fait confiance au mapping défini
-            if not sync_column and TRUST_COLUMN_MAPPING:
-                sync_column = AIRTABLE_SYNC_STATUS_COLUMNS.get(file_column)
-                if sync_column:
-                    logger.debug(f"Utilisation du mapping défini pour la colonne de statut: {sync_column}")
+            # Identifier les colonnes de statut et d'ID Sellsy correspondantes
+            _, sync_column, sellsy_id_column = column_plan
             
             if not sync_column:
-                logger.error(f"Colonne de statut de synchronisation non trouvée pour {file_column}. Impossible de marquer comme synchronisé.")
+                logger.error("Colonne de statut de synchronisation non trouvée pour %s. Impossible de marquer comme synchronisé.", file_column)
                 return False
             
-            # Vérifier que l'enregistrement existe toujours
-            record = self.table.get(record_id)
-            if not record:
-                logger.error(f"L'enregistrement {record_id} n'existe pas ou n'est plus accessible")
-                return False
-                
+            # OPTIMISATION: Ne pas renvoyer une mise à jour sans effet
+            if current_fields is not None and current_fields.get(sync_column) is True:
+                logger.debug("Colonne %s déjà synchronisée pour l'enregistrement %s", sync_column, record_id)
+                return True
+            
             # Logging des valeurs avant mise à jour
-            logger.info(f"Mise à jour pour le record {record_id}, colonne de statut {sync_column}")
+            logger.debug("Mise à jour pour le record %s, colonne de statut %s", record_id, sync_column)
             
             # Préparer les données à mettre à jour en utilisant une valeur booléenne explicite
             update_data = {
@@ -328,58 +992,232 @@ class AirtableAPI:
             }
             
             # Si un ID Sellsy est fourni et qu'une colonne dédiée existe, l'ajouter
-            sellsy_id_column = self.sellsy_id_columns.get(file_column)
-            
-            # CORRECTION: Avec TRUST_COLUMN_MAPPING activé, on fait confiance au mapping défini
-            if not sellsy_id_column and TRUST_COLUMN_MAPPING:
-                sellsy_id_column = AIRTABLE_SELLSY_ID_COLUMNS.get(file_column)
-                
             if sellsy_id and sellsy_id_column:
                 update_data[sellsy_id_column] = sellsy_id
-                logger.info(f"Stockage de l'ID Sellsy {sellsy_id} dans la colonne {sellsy_id_column}")
+                logger.debug("Stockage de l'ID Sellsy %s dans la colonne %s", sellsy_id, sellsy_id_column)
             elif sellsy_id:
-                logger.info(f"ID Sellsy {sellsy_id} généré mais pas de colonne pour le stocker")
+                logger.debug("ID Sellsy %s généré mais pas de colonne pour le stocker", sellsy_id)
             
             # Log de débogage
-            logger.info(f"Données de mise à jour: {update_data}")
-                
-            # Effectuer la mise à jour en utilisant la méthode correcte de l'API Airtable
-            result = self.table.update(record_id, update_data)
-            
-            # Vérifier que la mise à jour a bien été effectuée
-            if not result or not isinstance(result, dict):
-                logger.error(f"La mise à jour de l'enregistrement {record_id} a échoué ou n'a pas renvoyé de résultat valide")
-                return False
-                
-            # Log du résultat de la mise à jour
-            logger.info(f"Mise à jour réussie: {result.get('id') == record_id}")
+            logger.debug("Données de mise à jour: %s", update_data)
             
-            # Mettre à jour le statut global si nécessaire
+            # OPTIMISATION: Statut global calculé en mémoire, sans relire l'enregistrement
+            # CORRECTION: Il est envoyé dans un lot séparé: une erreur sur la colonne globale
+            # ne doit pas faire échouer les statuts des factures déjà envoyées à l'OCR
             if self.has_global_sync:
-                self._update_global_sync_status(record_id)
+                progress = self._sync_progress.get(record_id)
+                if progress is None:
+                    self._global_check_pending.add(record_id)
+                else:
+                    progress['done'].add(file_column)
+                    # CORRECTION: Comme la relecture complète, remettre aussi le statut global à False
+                    # s'il était coché alors qu'une facture de l'enregistrement reste à synchroniser
+                    all_synced = len(progress['done']) >= progress['total']
+                    if all_synced != progress['synced']:
+                        self._pending_global_updates[record_id] = all_synced
+                        progress['synced'] = all_synced
+                        if all_synced:
+                            logger.debug("Toutes les factures de l'enregistrement %s sont synchronisées", record_id)
+            
+            # Fusionner avec les mises à jour déjà en attente pour cet enregistrement
+            self._pending_updates.setdefault(record_id, {}).update(update_data)
+            
+            if flush:
+                _, failed_count = self._send_updates([record_id], retry=True)
+                return failed_count == 0
             
             return True
         except Exception as e:
-            logger.error(f"Erreur lors de la mise à jour du statut de synchronisation pour {file_column}: {e}")
+            logger.error("Erreur lors de la mise à jour du statut de synchronisation pour %s: %s", file_column, e)
             return False
 
+    def flush_updates(self, full_batches_only=False):
+        """
+        Envoie à Airtable les mises à jour en attente, par lots de 10 enregistrements
+        (maximum accepté par l'API Airtable pour une requête PATCH)
+        
+        Args:
+            full_batches_only (bool, optional): N'envoyer que des lots complets et garder le reste en attente
+                                                (les lots en échec sont alors retentés au prochain envoi)
+            
+        Returns:
+            tuple: (Nombre de factures dont le statut est confirmé par Airtable,
+                    nombre de factures dont la mise à jour a été abandonnée)
+        """
+        record_ids = list(self._pending_updates)
+        if full_batches_only:
+            record_ids = record_ids[:len(record_ids) - len(record_ids) % 10]
+        
+        return self._send_updates(record_ids, retry=not full_batches_only)
+
+    def _send_updates(self, record_ids, retry=False):
+        """
+        Envoie à Airtable les mises à jour en attente des enregistrements indiqués
+        Une mise à jour non confirmée est remise en attente, puis abandonnée après
+        MAX_UPDATE_ATTEMPTS envois
+        
+        Args:
+            record_ids (list): IDs des enregistrements dont la mise à jour est en attente
+            retry (bool, optional): Renvoyer aussitôt les mises à jour non confirmées
+            
+        Returns:
+            tuple: (Nombre de factures dont le statut est confirmé par Airtable,
+                    nombre de factures dont la mise à jour a été abandonnée)
+        """
+        synced_count = 0
+        failed_count = 0
+        # Enregistrements confirmés dont le statut global est en attente
+        global_ids = []
+        
+        while record_ids:
+            requeued_ids = []
+            for i in range(0, len(record_ids), 10):
+                batch_ids = record_ids[i:i + 10]
+                batch = [{"id": rid, "fields": self._pending_updates.pop(rid)} for rid in batch_ids]
+                
+                try:
+                    _rate_limiter.acquire()
+                    results = self.table.batch_update(batch) or []
+                except Exception as e:
+                    logger.error("Erreur lors de la mise à jour groupée de %s enregistrements: %s", len(batch), e)
+                    results = []
+                
+                # La réponse contient l'état à jour des enregistrements: la conserver évite une relecture,
+                # uniquement pour ceux dont le statut global devra être relu
+                for result in results:
+                    if result.get('id') in self._global_check_pending:
+                        self._cache_record(result)
+                
+                updated_ids = {result.get('id') for result in results}
+                failed_ids = [rid for rid in batch_ids if rid not in updated_ids]
+                if failed_ids and results:
+                    logger.error("Mise à jour non confirmée pour les enregistrements: %s", ', '.join(failed_ids))
+                if len(failed_ids) < len(batch_ids):
+                    logger.info("Mise à jour groupée réussie pour %s enregistrements", len(batch_ids) - len(failed_ids))
+                
+                for update in batch:
+                    rid = update["id"]
+                    # Nombre de factures couvertes par la mise à jour (une colonne de statut par facture)
+                    file_count = len(self._sync_columns.intersection(update["fields"]))
+                    
+                    if rid in updated_ids:
+                        synced_count += file_count
+                        self._update_attempts.pop(rid, None)
+                        if rid in self._pending_global_updates:
+                            global_ids.append(rid)
+                        continue
+                    
+                    # CORRECTION: Remettre en attente la mise à jour non confirmée au lieu de la perdre,
+                    # sans écraser une mise à jour plus récente du même enregistrement
+                    attempts = self._update_attempts.get(rid, 0) + 1
+                    if attempts < MAX_UPDATE_ATTEMPTS:
+                        self._update_attempts[rid] = attempts
+                        self._pending_updates[rid] = {**update["fields"], **self._pending_updates.get(rid, {})}
+                        requeued_ids.append(rid)
+                    else:
+                        self._update_attempts.pop(rid, None)
+                        # Le statut global ne peut plus être vrai sans les statuts des factures,
+                        # sa remise à False reste en revanche valable
+                        if self._pending_global_updates.get(rid) is False:
+                            global_ids.append(rid)
+                        else:
+                            self._pending_global_updates.pop(rid, None)
+                        self._globally_synced.discard(rid)
+                        failed_count += file_count
+                        logger.error("Mise à jour abandonnée après %s tentatives pour l'enregistrement %s: %s",
+                                     attempts, rid, ', '.join(update["fields"]))
+                
+                # Relire le statut global uniquement pour les enregistrements dont l'avancement est inconnu
+                for rid in batch_ids:
+                    if rid in updated_ids and rid in self._global_check_pending:
+                        self._global_check_pending.discard(rid)
+                        self._update_global_sync_status(rid)
+            
+            record_ids = requeued_ids if retry else []
+        
+        self._send_global_updates(global_ids)
+        self.synced_file_count += synced_count
+        self.failed_file_count += failed_count
+        return synced_count, failed_count
+
+    def _send_global_updates(self, record_ids):
+        """
+        Envoie à Airtable, par lots de 10, les statuts globaux en attente des enregistrements
+        indiqués (un échec est seulement journalisé: les statuts des factures sont déjà enregistrés)
+        
+        Args:
+            record_ids (list): IDs des enregistrements dont les factures sont confirmées
+        """
+        for i in range(0, len(record_ids), 10):
+            batch = [
+                {"id": rid, "fields": {AIRTABLE_SYNCED_COLUMN: self._pending_global_updates.pop(rid)}}
+                for rid in record_ids[i:i + 10]
+            ]
+            if not self.has_global_sync:
+                continue
+            
+            try:
+                _rate_limiter.acquire()
+                self.table.batch_update(batch)
+            except Exception as e:
+                logger.error("Erreur lors de la mise à jour du statut global de %s enregistrements: %s", len(batch), e)
+                if _is_airtable_error(e, "UNKNOWN_FIELD_NAME"):
+                    # Inutile de réessayer à chaque lot: la colonne n'existe pas dans la table
+                    logger.warning("Colonne %s introuvable, statut global désactivé", AIRTABLE_SYNCED_COLUMN)
+                    self.has_global_sync = False
+
+    def _cache_record(self, record):
+        """
+        Conserve un enregistrement dans le cache de lecture, en évinçant le plus ancien si besoin
+        
+        Args:
+            record (dict): Enregistrement Airtable complet
+        """
+        record_id = record.get('id')
+        if not record_id:
+            return
+        
+        self._record_cache.pop(record_id, None)
+        self._record_cache[record_id] = record
+        if len(self._record_cache) > RECORD_CACHE_SIZE:
+            self._record_cache.pop(next(iter(self._record_cache)))
+
+    def _get_record(self, record_id):
+        """
+        Renvoie un enregistrement depuis le cache de lecture, ou le lit dans Airtable
+        
+        Args:
+            record_id (str): ID de l'enregistrement Airtable
+            
+        Returns:
+            dict: Enregistrement Airtable, ou None s'il est introuvable
+        """
+        record = self._record_cache.get(record_id)
+        if record is None:
+            _rate_limiter.acquire()
+            record = self.table.get(record_id)
+            if record:
+                self._cache_record(record)
+        return record
+
     def _update_global_sync_status(self, record_id):
         """
         Met à jour le statut global de synchronisation si toutes les factures sont synchronisées
-        (Uniquement utilisé si le champ global existe)
+        (Uniquement utilisé si le champ global existe et pour les enregistrements qui n'ont pas
+        été obtenus via iter_unsynchronized_invoices)
         
         Args:
             record_id (str): ID de l'enregistrement Airtable
         """
-        # Ne rien faire si le champ global n'existe pas
-        if not self.has_global_sync:
+        # Ne rien faire si le champ global n'existe pas ou s'il est déjà à True
+        if not self.has_global_sync or record_id in self._globally_synced:
             return
             
         try:
             # Récupérer l'enregistrement complet pour obtenir les statuts à jour
-            record = self.table.get(record_id)
+            record = self._get_record(record_id)
             if not record:
-                logger.warning(f"Enregistrement {record_id} non trouvé lors de la mise à jour du statut global")
+                logger.warning("Enregistrement %s non trouvé lors de la mise à jour du statut global", record_id)
                 return
                 
             fields = record.get('fields', {})
@@ -388,17 +1226,12 @@ class AirtableAPI:
             has_attachments = False
             
             # Pour chaque colonne de facture
-            for column in AIRTABLE_INVOICE_FILE_COLUMNS:
+            for column, sync_column, _ in self._column_plan:
                 attachments = fields.get(column, [])
                 
                 # Si cette colonne a un fichier attaché
                 if attachments:
                     has_attachments = True
-                    sync_column = self.sync_status_columns.get(column)
-                    
-                    # CORRECTION: Avec TRUST_COLUMN_MAPPING activé, on fait confiance au mapping défini
-                    if not sync_column and TRUST_COLUMN_MAPPING:
-                        sync_column = AIRTABLE_SYNC_STATUS_COLUMNS.get(column)
                     
                     if sync_column:
                         # Vérifier si le statut est explicitement True
@@ -416,13 +1249,23 @@ class AirtableAPI:
                 current_global_status = fields.get(AIRTABLE_SYNCED_COLUMN, False)
                 
                 if all_synced != current_global_status:
-                    self.table.update(record_id, {
+                    _rate_limiter.acquire()
+                    result = self.table.update(record_id, {
                         AIRTABLE_SYNCED_COLUMN: all_synced
                     })
-                    logger.info(f"Statut global mis à jour à {all_synced} pour l'enregistrement {record_id}")
+                    if isinstance(result, dict):
+                        self._cache_record(result)
+                    else:
+                        self._record_cache.pop(record_id, None)
+                    logger.debug("Statut global mis à jour à %s pour l'enregistrement %s", all_synced, record_id)
+                
+                if all_synced:
+                    self._globally_synced.add(record_id)
+                else:
+                    self._globally_synced.discard(record_id)
         
         except Exception as e:
-            logger.error(f"Erreur lors de la mise à jour du statut global: {e}")
+            logger.error("Erreur lors de la mise à jour du statut global: %s", e)
 
     def get_invoice_data(self, record, file_column):
         """
@@ -446,21 +1289,10 @@ class AirtableAPI:
             "supplier_name": "", # Laissé vide pour l'OCR
         }
         
-        # Ajouter l'ID d'abonné si disponible
-        if self.has_subscriber_id:
-            invoice_data["subscriber_id"] = fields.get(AIRTABLE_SUBSCRIBER_ID_COLUMN, "")
-        else:
-            invoice_data["subscriber_id"] = ""
-            
-        # Ajouter prénom et nom si disponibles
-        if self.has_firstname:
-            invoice_data["first_name"] = fields.get(AIRTABLE_SUBSCRIBER_FIRSTNAME_COLUMN, "")
-        else:
-            invoice_data["first_name"] = ""
-            
-        if self.has_lastname:
-            invoice_data["last_name"] = fields.get(AIRTABLE_SUBSCRIBER_LASTNAME_COLUMN, "")
-        else:
-            invoice_data["last_name"] = ""
+        # Ajouter l'ID d'abonné, le prénom et le nom si les colonnes sont disponibles
+        invoice_data.update({
+            key: fields.get(column, "") if column else ""
+            for key, column in self._invoice_field_map
+        })
         
         return invoice_data
@@ -56,6 +56,43 @@ AIRTABLE_SELLSY_ID_COLUMN = "ID_Abonne"  # Changé de ID_Sellsy à ID_Abonne ou
 AIRTABLE_CREATED_DATE_COLUMN = "Created_Time"  # Colonne contenant la date de création de l'enregistrement
 AIRTABLE_SYNCED_COLUMN = "Sync_Status_Global"  # Renommé pour refléter un nom potentiellement différent
 
+# Vue Airtable optionnelle ne contenant que les enregistrements à synchroniser
+# Si elle est définie, elle remplace la formule de filtrage construite par le code
+AIRTABLE_NEEDS_SYNC_VIEW = os.environ.get("AIRTABLE_NEEDS_SYNC_VIEW", "")
+
+# Synchronisation incrémentale (désactivée si vide): colonne "Last Modified Time" de la table
+# Seuls les enregistrements modifiés depuis la dernière exécution sans erreur sont relus
+# ATTENTION: les colonnes de factures sont des lookups ("... (from Documents Abonnés 3)") et
+# Airtable ne met pas à jour "Last Modified Time" quand seule la valeur d'un lookup change:
+# une facture ajoutée à un document déjà lié ne serait pas détectée. À n'activer que si la
+# colonne suit un champ modifié à chaque ajout de facture sur cette table (lien ou pièce jointe)
+AIRTABLE_LAST_MODIFIED_COLUMN = os.environ.get("AIRTABLE_LAST_MODIFIED_COLUMN", "")
+
+# Limite de débit de l'API Airtable (5 requêtes par seconde et par base)
+AIRTABLE_REQUESTS_PER_SECOND = 5
+
+# Cache du schéma de la table (utilisé uniquement si TRUST_COLUMN_MAPPING est à False)
+AIRTABLE_SCHEMA_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache")  # Répertoire du cache
+AIRTABLE_SCHEMA_CACHE_TTL = 3600  # Durée de validité du cache en secondes
+AIRTABLE_SCHEMA_CACHE_MAX_STALE = 86400  # Âge maximal d'un cache expiré utilisable pendant son rafraîchissement
+
+# Répertoire du point de reprise de la synchronisation incrémentale (AIRTABLE_LAST_MODIFIED_COLUMN)
+# Il doit être conservé d'une exécution à l'autre, sinon chaque exécution relit toute la table
+AIRTABLE_SYNC_STATE_DIR = os.environ.get("AIRTABLE_SYNC_STATE_DIR", AIRTABLE_SCHEMA_CACHE_DIR)
+
+# Nombre de téléchargements de pièces jointes en parallèle (au moins 1)
+AIRTABLE_DOWNLOAD_WORKERS = max(1, int(os.environ.get("AIRTABLE_DOWNLOAD_WORKERS", "5")))
+
+# Répertoire des fichiers PDF téléchargés avant envoi (supprimés après l'envoi)
+# Par défaut /dev/shm (en mémoire) s'il est disponible, sinon le répertoire temporaire du système
+AIRTABLE_DOWNLOAD_TMP_DIR = os.environ.get(
+    "AIRTABLE_DOWNLOAD_TMP_DIR", "/dev/shm" if os.access("/dev/shm", os.W_OK) else ""
+)
+
+# Cache local des pièces jointes téléchargées (désactivé si vide)
+# Évite de retélécharger une facture lors d'une nouvelle tentative ou d'une reprise
+AIRTABLE_ATTACHMENT_CACHE_DIR = os.environ.get("AIRTABLE_ATTACHMENT_CACHE_DIR", "")
+
 # Configuration email pour l'OCR Sellsy
 EMAIL_HOST = os.environ.get("EMAIL_HOST", "smtp.gmail.com")  # SMTP par défaut Gmail
 EMAIL_PORT = int(os.environ.get("EMAIL_PORT", "587"))        # Port TLS par défaut
@@ -9,7 +9,7 @@ import time
 import sys
 from airtable_api import AirtableAPI  # Corrected import
 from email_sender import EmailSender
-from config import BATCH_SIZE, AIRTABLE_INVOICE_FILE_COLUMNS  # Corrected import
+from config import BATCH_SIZE  # Corrected import
 
 # Configuration améliorée du logging
 logging.basicConfig(
@@ -34,89 +34,122 @@ def sync_invoices_to_sellsy():
     logger.info("====================================================")
     
     # Initialiser les clients API
-    airtable = AirtableAPI()  # Version corrigée qui détecte la structure de la table
     email_client = EmailSender()
     
-    # Récupérer tous les enregistrements qui ont au moins une facture non synchronisée
-    # Pas de limite pour balayer toute la base
-    all_records = airtable.get_unsynchronized_invoices()
-    
-    if not all_records:
-        logger.info("Aucune facture à synchroniser")
-        return
-        
-    logger.info(f"Traitement de {len(all_records)} enregistrements contenant des factures non synchronisées")
-    
     # Compteurs pour le suivi
+    record_count = 0
     success_count = 0
     error_count = 0
     skipped_count = 0
     
-    # Traiter chaque enregistrement
-    for record in all_records:
-        record_id = record.get('id')
-        
-        logger.info(f"Traitement de l'enregistrement {record_id}")
+    # CORRECTION: Le gestionnaire de contexte envoie les statuts encore en attente même si
+    # la boucle est interrompue (exception, Ctrl+C), pour ne pas renvoyer ces factures à l'OCR
+    with AirtableAPI() as airtable:  # Version corrigée qui détecte la structure de la table
+        # Parcourir au fil de l'eau les enregistrements qui ont au moins une facture non synchronisée
+        # Pas de limite pour balayer toute la base
+        all_records = airtable.iter_unsynchronized_invoices()
         
-        # Traiter toutes les colonnes de facture non synchronisées pour cet enregistrement
-        for file_column in AIRTABLE_INVOICE_FILE_COLUMNS:
-            try:
-                # Vérifier si cette colonne contient un fichier à traiter
-                # La méthode corrigée get_next_unsynchronized_file vérifie si le fichier existe et n'est pas synchronisé
-                if file_column != airtable.get_next_unsynchronized_file(record):
-                    continue
+        # Traiter chaque enregistrement dès sa réception
+        for record in all_records:
+            record_id = record.get('id')
+            record_count += 1
+            
+            logger.info(f"Traitement de l'enregistrement {record_id}")
+            
+            # Traiter toutes les colonnes de facture non synchronisées pour cet enregistrement
+            # get_next_unsynchronized_file renvoie chaque colonne à traiter une seule fois, dans l'ordre
+            file_columns = []
+            while True:
+                file_column = airtable.get_next_unsynchronized_file(record)
+                if not file_column:
+                    break
+                file_columns.append(file_column)
+            
+            # OPTIMISATION: Télécharger en parallèle les fichiers PDF de l'enregistrement,
+            # puis les envoyer un par un au fur et à mesure qu'ils arrivent
+            downloads = airtable.download_many((record, file_column) for file_column in file_columns)
+            for _, file_column, pdf_path, original_filename in downloads:
+                try:
+                    logger.info(f"Traitement de la facture non synchronisée dans la colonne {file_column}")
+                        
+                    # Extraire les données minimales de la facture
+                    invoice_data = airtable.get_invoice_data(record, file_column)
                     
-                logger.info(f"Traitement de la facture non synchronisée dans la colonne {file_column}")
+                    if not pdf_path:
+                        logger.warning(f"Impossible de télécharger le fichier PDF depuis {file_column}")
+                        error_count += 1
+                        continue
+                        
+                    # Envoyer par email à l'OCR Sellsy
+                    logger.info(f"Envoi du PDF {original_filename} par email vers l'OCR Sellsy")
+                    email_result = email_client.send_invoice_to_ocr(invoice_data, pdf_path, original_filename)
                     
-                # Extraire les données minimales de la facture
-                invoice_data = airtable.get_invoice_data(record, file_column)
-                
-                # Télécharger le fichier PDF
-                pdf_path, original_filename = airtable.download_invoice_file(record, file_column)
-                
-                if not pdf_path:
-                    logger.warning(f"Impossible de télécharger le fichier PDF depuis {file_column}")
-                    error_count += 1
-                    continue
+                    if not email_result:
+                        logger.error(f"Échec de l'envoi par email à l'OCR pour la facture dans {file_column}")
+                        error_count += 1
+                        continue
+                        
+                    # Extraire l'ID de suivi du résultat
+                    sellsy_id = None
+                    if isinstance(email_result, dict):
+                        if "data" in email_result and "id" in email_result["data"]:
+                            sellsy_id = email_result["data"]["id"]
+                        elif "id" in email_result:
+                            sellsy_id = email_result["id"]
                     
-                # Envoyer par email à l'OCR Sellsy
-                logger.info(f"Envoi du PDF {original_filename} par email vers l'OCR Sellsy")
-                email_result = email_client.send_invoice_to_ocr(invoice_data, pdf_path, original_filename)
-                
-                if not email_result:
-                    logger.error(f"Échec de l'envoi par email à l'OCR pour la facture dans {file_column}")
-                    error_count += 1
-                    continue
+                    # Marquer cette facture spécifique comme synchronisée (envoi groupé à Airtable)
+                    # CORRECTION: Le succès n'est compté qu'une fois la mise à jour confirmée par Airtable
+                    if airtable.mark_file_as_synchronized(record_id, file_column, sellsy_id):
+                        logger.info(f"Facture dans {file_column} en attente de marquage comme synchronisée")
+                    else:
+                        logger.warning(f"Échec de la mise à jour du statut de synchronisation pour {file_column}")
+                        error_count += 1
                     
-                # Extraire l'ID de suivi du résultat
-                sellsy_id = None
-                if isinstance(email_result, dict):
-                    if "data" in email_result and "id" in email_result["data"]:
-                        sellsy_id = email_result["data"]["id"]
-                    elif "id" in email_result:
-                        sellsy_id = email_result["id"]
+                    # Pause courte pour éviter de saturer les APIs
+                    time.sleep(1)
                 
-                # Marquer cette facture spécifique comme synchronisée dans Airtable
-                if airtable.mark_file_as_synchronized(record_id, file_column, sellsy_id):
-                    logger.info(f"Facture dans {file_column} marquée comme synchronisée avec succès")
-                    success_count += 1
-                else:
-                    logger.warning(f"Échec de la mise à jour du statut de synchronisation pour {file_column}")
+                except Exception as e:
+                    logger.error(f"Erreur lors du traitement de la facture dans {file_column}: {e}")
                     error_count += 1
-                
-                # Pause courte pour éviter de saturer les APIs
-                time.sleep(1)
             
-            except Exception as e:
-                logger.error(f"Erreur lors du traitement de la facture dans {file_column}: {e}")
-                error_count += 1
+            # Toutes les factures de l'enregistrement sont traitées, son avancement n'est plus utile
+            airtable.release_record(record_id)
+            
+            # Envoyer les statuts de synchronisation à Airtable dès qu'un lot de 10 est complet
+            airtable.flush_updates(full_batches_only=True)
+            
+            # Ajoutons une pause plus courte entre les enregistrements pour réduire la charge
+            time.sleep(0.5)
         
-        # Ajoutons une pause plus courte entre les enregistrements pour réduire la charge
-        time.sleep(0.5)
+        # Envoyer les derniers statuts de synchronisation en attente
+        airtable.flush_updates()
+        
+        # Totaux des statuts confirmés ou abandonnés, y compris ceux envoyés lors d'une
+        # reprise du parcours Airtable (curseur de pagination expiré)
+        success_count = airtable.synced_file_count
+        error_count += airtable.failed_file_count
+        
+        # CORRECTION: Une erreur de pagination interrompt le parcours sans lever d'exception
+        listing_failed = airtable.listing_failed
+        if listing_failed:
+            error_count += 1
+        
+        # Le point de reprise n'avance que si aucune facture n'est restée en échec
+        if not error_count:
+            airtable.save_sync_watermark()
+    
+    if not record_count:
+        # CORRECTION: Un parcours en échec dès la première page ne signifie pas "rien à synchroniser"
+        if listing_failed:
+            logger.error("Échec de la récupération des factures Airtable, aucune facture traitée")
+        else:
+            logger.info("Aucune facture à synchroniser")
+        return
     
     # Résumé de la synchronisation
     logger.info("====================================================")
     logger.info(f"Synchronisation terminée:")
+    logger.info(f"  - {record_count} enregistrements traités")
     logger.info(f"  - {success_count} factures envoyées avec succès")
     logger.info(f"  - {skipped_count} factures déjà synchronisées")
     logger.info(f"  - {error_count} erreurs rencontrées")
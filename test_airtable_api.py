@@ -0,0 +1,575 @@
+"""
+Tests hors ligne du client Airtable: la table est simulée en mémoire, aucun appel réseau
+Lancement: python -m unittest test_airtable_api
+"""
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# Variables requises par config.py, sans valeur réelle
+os.environ.setdefault("AIRTABLE_API_KEY", "test")
+os.environ.setdefault("AIRTABLE_BASE_ID", "appTest")
+os.environ.setdefault("AIRTABLE_TABLE_NAME", "Factures")
+
+import requests
+
+import airtable_api
+from config import AIRTABLE_INVOICE_FILE_COLUMNS, AIRTABLE_SYNC_STATUS_COLUMNS, AIRTABLE_SYNCED_COLUMN
+
+
+def make_record(record_id, attached=(), synced=()):
+    """Construit un enregistrement avec une pièce jointe dans les colonnes indiquées (par index)"""
+    fields = {"Prenom": "Jean", "Nom": "Dupont", "ID_Abonne": record_id}
+    for index in attached:
+        column = AIRTABLE_INVOICE_FILE_COLUMNS[index]
+        fields[column] = [{"id": f"att{record_id}{index}", "url": f"https://dl/{record_id}/{index}", "filename": "f.pdf"}]
+        if index in synced:
+            fields[AIRTABLE_SYNC_STATUS_COLUMNS[column]] = True
+    return {"id": record_id, "fields": fields}
+
+
+def airtable_error(error_type):
+    """Erreur 422 renvoyée par Airtable avec le type indiqué"""
+    response = requests.Response()
+    response.status_code = 422
+    response._content = json.dumps({"error": {"type": error_type}}).encode()
+    return requests.HTTPError("422 Client Error", repr({"type": error_type}), response=response)
+
+
+class FakeTable:
+    """
+    Table Airtable en mémoire; une formule sélectionne les enregistrements ayant une facture
+    non synchronisée dans l'une des colonnes qu'elle cite
+    """
+
+    def __init__(self, records):
+        self.records = {record["id"]: record for record in records}
+        self.page_size = None         # Taille de page imposée (sinon celle demandée)
+        self.fail_on_page = None      # Numéro de page (à partir de 1) qui lève une erreur
+        self.expire_on_page = None    # Numéro de page dont le curseur a expiré (une seule fois)
+        self.fail_batches = 0         # Nombre d'appels batch_update qui échouent
+        self.unknown_fields = set()   # Colonnes rejetées avec UNKNOWN_FIELD_NAME
+        self.iterate_calls = []
+        self.batches = []
+
+    def _matches(self, record, formula):
+        if not formula:
+            return True
+        fields = record["fields"]
+        columns = [column for column in AIRTABLE_INVOICE_FILE_COLUMNS if "{" + column + "}" in formula]
+        return any(fields.get(column) and not fields.get(AIRTABLE_SYNC_STATUS_COLUMNS[column]) for column in columns)
+
+    def iterate(self, **options):
+        self.iterate_calls.append(options)
+        if self.unknown_fields.intersection(options.get("fields") or ()):
+            raise airtable_error("UNKNOWN_FIELD_NAME")
+
+        records = [
+            {"id": record["id"], "fields": {
+                key: value for key, value in record["fields"].items()
+                if "fields" not in options or key in options["fields"]
+            }}
+            for record in self.records.values() if self._matches(record, options.get("formula"))
+        ]
+        if options.get("max_records"):
+            records = records[:options["max_records"]]
+
+        page_size = self.page_size or options.get("page_size", 100)
+        for page_number, start in enumerate(range(0, len(records), page_size), 1):
+            if page_number == self.fail_on_page:
+                raise requests.ConnectionError("connexion interrompue")
+            if page_number == self.expire_on_page:
+                self.expire_on_page = None
+                raise airtable_error("LIST_RECORDS_ITERATOR_NOT_AVAILABLE")
+            yield records[start:start + page_size]
+
+    def batch_update(self, records):
+        assert len(records) <= 10, "Airtable accepte au plus 10 enregistrements par requête"
+        self.batches.append(records)
+        if self.fail_batches:
+            self.fail_batches -= 1
+            raise requests.ConnectionError("connexion interrompue")
+        if any(self.unknown_fields.intersection(record["fields"]) for record in records):
+            raise airtable_error("UNKNOWN_FIELD_NAME")
+
+        results = []
+        for record in records:
+            self.records[record["id"]]["fields"].update(record["fields"])
+            results.append(self.records[record["id"]])
+        return results
+
+
+class AirtableAPITestCase(unittest.TestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+
+        for patcher in (
+            mock.patch.object(airtable_api, "AIRTABLE_SCHEMA_CACHE_DIR", self.cache_dir),
+            mock.patch.object(airtable_api, "_rate_limiter", airtable_api._RateLimiter(10000)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_api(self, table):
+        """Crée un client AirtableAPI branché sur la table simulée"""
+        with mock.patch("pyairtable.Table", lambda *args: table):
+            api = airtable_api.AirtableAPI()
+        self.addCleanup(api._session.close)
+        return api
+
+
+class FormulaTest(AirtableAPITestCase):
+    def test_single_formula_under_limit(self):
+        api = self.make_api(FakeTable([]))
+        self.assertEqual(len(api._unsync_formulas), 1)
+        for column in AIRTABLE_INVOICE_FILE_COLUMNS:
+            self.assertIn("{" + column + "}", api._unsync_formulas[0])
+
+    def test_formula_split_at_max_length(self):
+        with mock.patch.object(airtable_api, "MAX_FORMULA_LENGTH", 120):
+            api = self.make_api(FakeTable([]))
+
+        self.assertEqual(len(api._unsync_formulas), len(AIRTABLE_INVOICE_FILE_COLUMNS))
+        for formula in api._unsync_formulas:
+            self.assertLessEqual(len(formula), 120)
+
+    def test_split_formulas_do_not_duplicate_records(self):
+        table = FakeTable([
+            make_record("rec1", attached=(0, 1, 2)),
+            make_record("rec2", attached=(1, 2), synced=(1,)),
+            make_record("rec3", attached=(2,)),
+            make_record("rec4", attached=(0,), synced=(0,)),
+        ])
+        with mock.patch.object(airtable_api, "MAX_FORMULA_LENGTH", 120):
+            api = self.make_api(table)
+
+        record_ids = [record["id"] for record in api.iter_unsynchronized_invoices()]
+        self.assertEqual(sorted(record_ids), ["rec1", "rec2", "rec3"])
+        self.assertEqual(len(table.iterate_calls), len(AIRTABLE_INVOICE_FILE_COLUMNS))
+
+
+class StreamingTest(AirtableAPITestCase):
+    def test_expired_cursor_restarts_after_flush(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(5)])
+        table.page_size = 2
+        table.expire_on_page = 2
+        api = self.make_api(table)
+
+        record_ids = []
+        for record in api.iter_unsynchronized_invoices():
+            record_ids.append(record["id"])
+            column = api.get_next_unsynchronized_file(record)
+            api.mark_file_as_synchronized(record["id"], column)
+        api.flush_updates()
+
+        # Les statuts de la première page sont envoyés avant la reprise: elle ne la renvoie pas
+        self.assertEqual(record_ids, [f"rec{i}" for i in range(5)])
+        self.assertFalse(api.listing_failed)
+        self.assertEqual(len(table.iterate_calls), 2)
+        self.assertEqual(api.synced_file_count, 5)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_steady_rate(self):
+        clock = [100.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        with mock.patch.object(airtable_api.time, "monotonic", lambda: clock[0]), \
+                mock.patch.object(airtable_api.time, "sleep", sleep):
+            limiter = airtable_api._RateLimiter(5)
+            for _ in range(15):
+                limiter.acquire()
+
+        # 5 requêtes immédiates, puis une toutes les 0,2 s
+        self.assertEqual(len(sleeps), 10)
+        self.assertAlmostEqual(clock[0] - 100.0, 2.0)
+
+
+def mark_all(api):
+    """Marque comme synchronisées toutes les factures en attente de la table"""
+    for record in api.iter_unsynchronized_invoices():
+        while True:
+            column = api.get_next_unsynchronized_file(record)
+            if not column:
+                break
+            assert api.mark_file_as_synchronized(record["id"], column)
+
+
+class FlushTest(AirtableAPITestCase):
+    def file_batches(self, table):
+        status_columns = set(AIRTABLE_SYNC_STATUS_COLUMNS.values())
+        return [batch for batch in table.batches if status_columns.intersection(batch[0]["fields"])]
+
+    def test_already_synced_column_not_sent_again(self):
+        api = self.make_api(FakeTable([make_record("rec1", attached=(0,))]))
+        column = AIRTABLE_INVOICE_FILE_COLUMNS[0]
+        current_fields = make_record("rec1", attached=(0,), synced=(0,))["fields"]
+
+        self.assertTrue(api.mark_file_as_synchronized("rec1", column, current_fields=current_fields))
+        self.assertFalse(api._pending_updates)
+
+    def test_batches_of_ten(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0, 1)) for i in range(23)])
+        api = self.make_api(table)
+        mark_all(api)
+
+        self.assertEqual(api.flush_updates(full_batches_only=True), (40, 0))
+        self.assertEqual(len(api._pending_updates), 3)
+        self.assertEqual(api.flush_updates(), (6, 0))
+        self.assertEqual([len(batch) for batch in self.file_batches(table)], [10, 10, 3])
+        self.assertTrue(all(record["fields"].get(AIRTABLE_SYNCED_COLUMN) for record in table.records.values()))
+
+    def test_failed_batch_is_requeued(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(3)])
+        table.fail_batches = 1
+        api = self.make_api(table)
+        mark_all(api)
+
+        self.assertEqual(api.flush_updates(), (3, 0))
+        self.assertFalse(api._pending_updates)
+        self.assertEqual(len(self.file_batches(table)), 2)
+
+    def test_update_abandoned_after_max_attempts(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(3)])
+        table.fail_batches = airtable_api.MAX_UPDATE_ATTEMPTS
+        api = self.make_api(table)
+        mark_all(api)
+
+        self.assertEqual(api.flush_updates(), (0, 3))
+        self.assertFalse(api._pending_updates)
+        self.assertFalse(any(record["fields"].get(AIRTABLE_SYNCED_COLUMN) for record in table.records.values()))
+
+
+class GlobalStatusTest(AirtableAPITestCase):
+    def test_unknown_global_column_keeps_file_statuses(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(3)])
+        table.unknown_fields = {AIRTABLE_SYNCED_COLUMN}
+        api = self.make_api(table)
+        mark_all(api)
+
+        self.assertEqual(api.flush_updates(), (3, 0))
+        self.assertFalse(api.has_global_sync)
+        status_column = AIRTABLE_SYNC_STATUS_COLUMNS[AIRTABLE_INVOICE_FILE_COLUMNS[0]]
+        self.assertTrue(all(record["fields"].get(status_column) for record in table.records.values()))
+
+
+
+    def test_global_flag_sent_in_its_own_batch(self):
+        table = FakeTable([make_record("rec1", attached=(0, 1))])
+        api = self.make_api(table)
+        mark_all(api)
+
+        self.assertEqual(api.flush_updates(), (2, 0))
+        file_batch, global_batch = table.batches
+        self.assertNotIn(AIRTABLE_SYNCED_COLUMN, file_batch[0]["fields"])
+        self.assertEqual(global_batch, [{"id": "rec1", "fields": {AIRTABLE_SYNCED_COLUMN: True}}])
+
+    def test_global_flag_reset_while_an_invoice_is_unsynced(self):
+        record = make_record("rec1", attached=(0, 1))
+        record["fields"][AIRTABLE_SYNCED_COLUMN] = True
+        table = FakeTable([record])
+        api = self.make_api(table)
+
+        record = next(api.iter_unsynchronized_invoices())
+        column = api.get_next_unsynchronized_file(record)
+        api.mark_file_as_synchronized(record["id"], column)
+        api.flush_updates()
+        self.assertIs(table.records["rec1"]["fields"][AIRTABLE_SYNCED_COLUMN], False)
+
+        column = api.get_next_unsynchronized_file(record)
+        api.mark_file_as_synchronized(record["id"], column)
+        api.flush_updates()
+        self.assertIs(table.records["rec1"]["fields"][AIRTABLE_SYNCED_COLUMN], True)
+
+
+class ProjectionTest(AirtableAPITestCase):
+    def test_unknown_projected_column_falls_back(self):
+        table = FakeTable([make_record("rec1", attached=(0,))])
+        table.unknown_fields = {"Prenom"}
+        api = self.make_api(table)
+
+        records = list(api.iter_unsynchronized_invoices())
+        self.assertEqual([record["id"] for record in records], ["rec1"])
+        self.assertFalse(api.listing_failed)
+        self.assertEqual(api._read_fields, ())
+        self.assertNotIn("fields", table.iterate_calls[-1])
+
+
+class PendingQueueTest(AirtableAPITestCase):
+    def test_columns_returned_once_in_order(self):
+        table = FakeTable([make_record("rec1", attached=(0, 1, 2), synced=(1,))])
+        api = self.make_api(table)
+        record = next(api.iter_unsynchronized_invoices())
+
+        columns = [api.get_next_unsynchronized_file(record) for _ in range(3)]
+        self.assertEqual(columns, [AIRTABLE_INVOICE_FILE_COLUMNS[0], AIRTABLE_INVOICE_FILE_COLUMNS[2], None])
+
+    def test_record_unknown_to_the_listing(self):
+        api = self.make_api(FakeTable([]))
+        record = make_record("rec1", attached=(1, 2), synced=(2,))
+
+        self.assertEqual(api.get_next_unsynchronized_file(record), AIRTABLE_INVOICE_FILE_COLUMNS[1])
+        self.assertIsNone(api.get_next_unsynchronized_file(record))
+
+
+class FakeResponse:
+    """Réponse HTTP en flux, utilisée comme gestionnaire de contexte"""
+
+    def __init__(self, content, headers=None, fail_after=None):
+        self.headers = headers or {}
+        self.raw = io.BytesIO(content)
+        if fail_after is not None:
+            # Coupure de la connexion après fail_after octets
+            data = content[:fail_after]
+            self.raw = mock.Mock(read=mock.Mock(side_effect=[data, requests.ConnectionError("coupure")]))
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """Session HTTP simulée: renvoie pour chaque URL la réponse fabriquée par `respond`"""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return self.respond(url)
+
+    def close(self):
+        pass
+
+
+class DownloadTestCase(AirtableAPITestCase):
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        patcher = mock.patch.object(airtable_api, "AIRTABLE_DOWNLOAD_TMP_DIR", self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_download_api(self, respond):
+        api = self.make_api(FakeTable([]))
+        api._session = FakeSession(respond)
+        return api
+
+    def download(self, api, record):
+        file_path, _ = api.download_invoice_file(record, AIRTABLE_INVOICE_FILE_COLUMNS[0])
+        if file_path:
+            self.addCleanup(lambda: os.path.exists(file_path) and os.unlink(file_path))
+        return file_path
+
+
+class AttachmentCacheTest(DownloadTestCase):
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.attachment_dir = cache_dir.name
+        patcher = mock.patch.object(airtable_api, "AIRTABLE_ATTACHMENT_CACHE_DIR", self.attachment_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_hit_skips_download(self):
+        api = self.make_download_api(lambda url: FakeResponse(b"%PDF-1.4"))
+        record = make_record("rec1", attached=(0,))
+
+        first_path = self.download(api, record)
+        second_path = self.download(api, record)
+
+        self.assertEqual(len(api._session.urls), 1)
+        self.assertNotEqual(first_path, second_path)
+        with open(second_path, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4")
+        self.assertEqual(os.listdir(self.attachment_dir), ["attrec10.pdf"])
+
+    def test_size_mismatch_downloads_again(self):
+        api = self.make_download_api(lambda url: FakeResponse(b"%PDF-1.4"))
+        record = make_record("rec1", attached=(0,))
+        record["fields"][AIRTABLE_INVOICE_FILE_COLUMNS[0]][0]["size"] = 8
+        with open(os.path.join(self.attachment_dir, "attrec10.pdf"), "wb") as f:
+            f.write(b"tronqu")
+
+        file_path = self.download(api, record)
+
+        self.assertEqual(len(api._session.urls), 1)
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(), b"%PDF-1.4")
+
+    def test_interrupted_download_leaves_no_cache_entry(self):
+        api = self.make_download_api(lambda url: FakeResponse(b"%PDF-1.4", fail_after=4))
+        record = make_record("rec1", attached=(0,))
+
+        self.assertIsNone(self.download(api, record))
+        # Le fichier .part est supprimé et n'est jamais renommé en entrée du cache
+        self.assertEqual(os.listdir(self.attachment_dir), [])
+
+
+class PreallocationTest(DownloadTestCase):
+    def test_preallocated_file_truncated_to_received_size(self):
+        api = self.make_download_api(lambda url: FakeResponse(b"%PDF-1.4", {"Content-Length": "4096"}))
+        # Préallocation simulée par une extension réelle du fichier
+        allocate = lambda fd, offset, length: os.ftruncate(fd, offset + length)
+        with mock.patch.object(airtable_api.os, "posix_fallocate", side_effect=allocate, create=True) as fallocate:
+            file_path = self.download(api, make_record("rec1", attached=(0,)))
+
+        self.assertEqual(fallocate.call_args.args[1:], (0, 4096))
+        self.assertEqual(os.path.getsize(file_path), len(b"%PDF-1.4"))
+
+    def test_no_preallocation_for_encoded_content(self):
+        headers = {"Content-Length": "4096", "Content-Encoding": "gzip"}
+        api = self.make_download_api(lambda url: FakeResponse(b"%PDF-1.4", headers))
+        with mock.patch.object(airtable_api.os, "posix_fallocate", create=True) as fallocate:
+            self.download(api, make_record("rec1", attached=(0,)))
+
+        fallocate.assert_not_called()
+
+
+class MetaResponse:
+    """Réponse de l'API Meta d'Airtable"""
+
+    def __init__(self, field_names):
+        self.status_code = 200
+        self._payload = {"tables": [{"name": os.environ["AIRTABLE_TABLE_NAME"],
+                                     "fields": [{"name": name} for name in field_names]}]}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+SCHEMA_FIELDS = AIRTABLE_INVOICE_FILE_COLUMNS + list(AIRTABLE_SYNC_STATUS_COLUMNS.values()) + ["Prenom", "Nom"]
+
+
+class SchemaCacheTestCase(AirtableAPITestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(airtable_api, "TRUST_COLUMN_MAPPING", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class SchemaCacheTest(SchemaCacheTestCase):
+    def test_meta_schema_fetched_once_then_cached(self):
+        with mock.patch("requests.get", return_value=MetaResponse(SCHEMA_FIELDS)) as meta_get:
+            api = self.make_api(FakeTable([]))
+            self.make_api(FakeTable([]))
+
+        self.assertEqual(meta_get.call_count, 1)
+        self.assertIn("/meta/bases/", meta_get.call_args.args[0])
+        self.assertEqual(api._table_fields, frozenset(SCHEMA_FIELDS))
+        self.assertTrue(api.has_firstname)
+        self.assertFalse(api.has_subscriber_id)
+        self.assertFalse(api.has_global_sync)
+        self.assertEqual(len(api._sync_pairs), len(AIRTABLE_INVOICE_FILE_COLUMNS))
+
+
+class StaleSchemaTest(SchemaCacheTestCase):
+    def write_cache(self, field_names, age):
+        cache_path = os.path.join(self.cache_dir, "airtable_schema_{}_{}.json".format(
+            os.environ["AIRTABLE_BASE_ID"], os.environ["AIRTABLE_TABLE_NAME"]))
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(field_names, f)
+        mtime = airtable_api.time.time() - age
+        os.utime(cache_path, (mtime, mtime))
+        return cache_path
+
+    def test_stale_cache_used_then_refreshed(self):
+        stale_fields = SCHEMA_FIELDS[:-1]
+        cache_path = self.write_cache(stale_fields, airtable_api.AIRTABLE_SCHEMA_CACHE_TTL + 60)
+
+        # Rafraîchissement exécuté immédiatement au lieu d'un thread d'arrière-plan
+        def run_now(target, daemon):
+            return mock.Mock(start=target)
+
+        with mock.patch("requests.get", return_value=MetaResponse(SCHEMA_FIELDS)) as meta_get, \
+                mock.patch.object(airtable_api.threading, "Thread", side_effect=run_now):
+            api = self.make_api(FakeTable([]))
+
+        self.assertEqual(api._table_fields, frozenset(stale_fields))
+        self.assertEqual(meta_get.call_count, 1)
+        with open(cache_path, encoding="utf-8") as f:
+            self.assertEqual(set(json.load(f)), set(SCHEMA_FIELDS))
+
+    def test_too_old_cache_is_not_used(self):
+        self.write_cache(SCHEMA_FIELDS[:-1], airtable_api.AIRTABLE_SCHEMA_CACHE_MAX_STALE + 60)
+
+        with mock.patch("requests.get", return_value=MetaResponse(SCHEMA_FIELDS)):
+            api = self.make_api(FakeTable([]))
+
+        self.assertEqual(api._table_fields, frozenset(SCHEMA_FIELDS))
+
+
+class WatermarkTest(AirtableAPITestCase):
+    def setUp(self):
+        super().setUp()
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        self.state_dir = state_dir.name
+        for patcher in (
+            mock.patch.object(airtable_api, "AIRTABLE_LAST_MODIFIED_COLUMN", "Last Modified"),
+            mock.patch.object(airtable_api, "AIRTABLE_SYNC_STATE_DIR", self.state_dir),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        table = FakeTable([make_record("rec1", attached=(0,))])
+        api = self.make_api(table)
+        self.assertNotIn("IS_AFTER", api._unsync_formulas[0])
+
+        list(api.iter_unsynchronized_invoices())
+        api.save_sync_watermark()
+        self.assertEqual(os.path.dirname(api._sync_state_path()), self.state_dir)
+        with open(api._sync_state_path(), encoding="utf-8") as f:
+            last_sync_at = json.load(f)["last_sync_at"]
+        self.assertEqual(last_sync_at, api._run_started_at - airtable_api.SYNC_WATERMARK_MARGIN)
+
+        next_api = self.make_api(table)
+        since = airtable_api.time.strftime("%Y-%m-%dT%H:%M:%S.000Z", airtable_api.time.gmtime(last_sync_at))
+        for formula in next_api._unsync_formulas:
+            self.assertIn(f"IS_AFTER({{Last Modified}},DATETIME_PARSE('{since}'))", formula)
+
+    def test_page_failure_keeps_watermark(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(5)])
+        table.page_size = 2
+        table.fail_on_page = 2
+        api = self.make_api(table)
+
+        self.assertEqual(len(list(api.iter_unsynchronized_invoices())), 2)
+        self.assertTrue(api.listing_failed)
+        api.save_sync_watermark()
+        self.assertFalse(os.path.exists(api._sync_state_path()))
+
+    def test_limited_listing_keeps_watermark(self):
+        table = FakeTable([make_record(f"rec{i}", attached=(0,)) for i in range(5)])
+        api = self.make_api(table)
+
+        list(api.iter_unsynchronized_invoices(limit=2))
+        api.save_sync_watermark()
+        self.assertFalse(os.path.exists(api._sync_state_path()))
+
+
+if __name__ == "__main__":
+    unittest.main()